@@ -23,6 +23,8 @@ cfg = {
     'use_CoordConv': True,
     'with_r': False,
     'add_CoordConv_inHG': False,
+    # Downsample with stride-2 convs instead of max pooling in the base part and hourglass
+    'strided_downsample': True,
     ### Attention Block ###
     'attention_block_idx': 2,
     'attention_blocks': {0: "None",
@@ -42,6 +44,10 @@ cfg = {
     'batch_size':8,
     'update_batch_size': 8,
     'epoch':20,
+    ### Performance setting ###
+    'channels_last': True, # NHWC memory format for the cuDNN NHWC kernels (some shapes may regress)
+    'use_amp': True, # mixed precision training, only works on cuda
+    'compile': False, # torch.compile the model for training, needs PyTorch >= 2.0
     ### training setting ##
     'train_annot':'../data/synthetics_train/annot.pkl',
     'train_data_root':'../data/synthetics_train',
@@ -2,7 +2,7 @@ import torch
 from torch.utils.data import DataLoader
 import argparse
 from utils.evaluation import *
-from model.tool import get_model
+from model.tool import get_model, script_model
 from dataset.tool import get_test_dataset
 from utils.tool import load_parameters, val
 from utils.visualize import plot_loss_68
@@ -14,6 +14,8 @@ def main():
     parser.add_argument('--model_path', type=str, default="./save/best.pt")
     parser.add_argument('--annot_path', type=str, default="../data/aflw_val/annot.pkl")
     parser.add_argument('--data_path', type=str, default="../data/aflw_val")
+    parser.add_argument('--fuse', help="fold the BN layers into the convs", action="store_true")
+    parser.add_argument('--jit', help="compile the model with TorchScript", action="store_true")
     # parser.add_argument('--type', type=str, default="val")
     args = parser.parse_args()
 
@@ -34,7 +36,13 @@ def main():
     model = get_model(cfg)
 
     load_parameters(model, model_path)
-    test_NME_loss, test_NME_loss_68 = val(model, test_loader, device, fix_coord=fix_coord)
+    if args.fuse:
+        model = model.eval().fuse()
+    if args.jit:
+        model = model.to(device)
+        model = script_model(model, next(iter(test_loader))['img'].to(device))
+    test_NME_loss, test_NME_loss_68 = val(model, test_loader, device, fix_coord=fix_coord, 
+                                        use_amp=cfg['use_amp'] and device.type == 'cuda')
     print(f"Average NME Loss : {test_NME_loss:.6f}")
     plot_loss_68(test_NME_loss_68)
     print(np.argsort(test_NME_loss_68))
@@ -35,8 +35,9 @@ class Adaptive_Wing_Loss(nn.Module):
     def forward(self, pred, target, weight_map):
         """
         Args:
-            pred: shape=(B, N, H, W)
-            target: shape=(B, N, H, W)
+            pred: shape=(..., B, N, H, W)
+            target: shape=(..., B, N, H, W)
+            weight_map: shape=(..., B, N, H, W)
         """
         w = self.weight * (weight_map + 1)
         y = target
@@ -89,8 +89,10 @@ def main():
                                             aug_setting=aug_setting)
     print("End of Loading annotation!!!")
 
-    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers= 2, pin_memory=True, drop_last=True)
-    val_loader = DataLoader(val_set, batch_size=batch_size, shuffle=False, num_workers= 2, pin_memory=True, drop_last=True)
+    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers= 2, pin_memory=True, drop_last=True,
+                            persistent_workers=True, prefetch_factor=2)
+    val_loader = DataLoader(val_set, batch_size=batch_size, shuffle=False, num_workers= 2, pin_memory=True, drop_last=True,
+                            persistent_workers=True, prefetch_factor=2)
 
     params = add_weight_decay(model, weight_decay)
     # Optimizer
@@ -116,7 +118,8 @@ def main():
     
     # Testing data
     test_set = get_test_dataset(val_data_root, val_annot)
-    test_loader = DataLoader(test_set, batch_size=batch_size, num_workers= 2, pin_memory=True)
+    test_loader = DataLoader(test_set, batch_size=batch_size, num_workers= 2, pin_memory=True,
+                            persistent_workers=True, prefetch_factor=2)
 
 
     # model save path
@@ -142,6 +145,7 @@ def main():
     print(f"Use CoordConv = {cfg['use_CoordConv']}")
     print(f"With_r = {cfg['with_r']}")
     print(f"Add CoordConv inHG = {cfg['add_CoordConv_inHG']}")
+    print(f"Strided downsample = {cfg['strided_downsample']}")
     print(f"Aug setting = {aug_setting}")
     print(f"Backgroud negative = {cfg['bg_negative']}")
     print(f"Batch Size = {cfg['batch_size']}")
@@ -166,6 +170,7 @@ def main():
                 'use_CoordConv':cfg['use_CoordConv'],
                 'with_r': cfg['with_r'],
                 'add_CoordConv_inHG':cfg['add_CoordConv_inHG'],
+                'strided_downsample':cfg['strided_downsample'],
                 'attention_block' : cfg['attention_blocks'][cfg['attention_block_idx']]}
 
     
@@ -185,7 +190,10 @@ def main():
         fix_coord=fix_coord,
         every_step_update=every_step_update,
         train_hyp=train_hyp,
-        resume_epoch=resume_epoch)
+        resume_epoch=resume_epoch,
+        channels_last=cfg['channels_last'],
+        use_amp=cfg['use_amp'] and device.type == 'cuda',
+        compile_model=cfg['compile'])
 
     
 
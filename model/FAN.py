@@ -1,11 +1,14 @@
+import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from model.blocks import conv1x1
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from typing import List
+from model.blocks import conv1x1, upsample_add
 from model.blocks import HPM_ConvBlock, SELayer, CA_Block
 from model.blocks import CoordConv
 import math
 class HourGlassNet(nn.Module):
-    def __init__(self, depth:int, num_feats:int, resBlock=HPM_ConvBlock, attention_block=None, add_CoordConv=False, with_r=False):
+    def __init__(self, depth:int, num_feats:int, resBlock=HPM_ConvBlock, attention_block=None, add_CoordConv=False, with_r=False,
+                strided_downsample=False):
         super(HourGlassNet, self).__init__()
         self.depth = depth
         self.num_feats = num_feats
@@ -13,125 +16,165 @@ class HourGlassNet(nn.Module):
         self.add_CoordConv = add_CoordConv
         if self.add_CoordConv:
             self.coordConv = CoordConv(self.num_feats, self.num_feats, with_r=with_r, kernel_size=1, stride=1, padding=0)
+        else:
+            self.coordConv = None
         self.attention_block = attention_block
-        self.downsample = nn.MaxPool2d(kernel_size=2, stride=2)
-        for level in range(1, depth + 1):
-            # upper branch
-            self.add_module(f"shortcut{level}", resBlock(self.num_feats, self.num_feats))
-            # lower branch
-            self.add_module(f"conv{level}_1", resBlock(self.num_feats, self.num_feats))
-            self.add_module(f"conv{level}_2", resBlock(self.num_feats, self.num_feats))
-
-            if attention_block != None:
-                if attention_block == SELayer:
-                    self.add_module(f"attention{level}", attention_block(self.num_feats))
-                elif attention_block == CA_Block:
-                    self.add_module(f"attention{level}", attention_block(self.num_feats, self.num_feats))
-                else:
-                    raise ValueError("This attention block doesn't exist!")
-            if level == depth:
-                self.add_module(f"conv_middle", resBlock(self.num_feats, self.num_feats))
+        # Downsample with pooling or with the stride of the first conv in the lower branch
+        if strided_downsample:
+            self.downsample = None
+        else:
+            self.downsample = nn.MaxPool2d(kernel_size=2, stride=2)
+        lower_stride = 2 if strided_downsample else 1
 
-    def _forward(self, x, level:int):
-        residual = x
+        # The modules are stored in the order they are visited, so that forward can zip over them:
+        # shortcuts and conv1s from the outermost level, conv2s and attentions from the innermost level.
         # upper branch
-        residual = self._modules[f"shortcut{level}"](residual)
+        self.shortcuts = nn.ModuleList([resBlock(self.num_feats, self.num_feats) for _ in range(depth)])
         # lower branch
-        x = self.downsample(x)
-        x = self._modules[f"conv{level}_1"](x)
-        
-        if level == self.depth:
-            # End recursion
-            x = self._modules["conv_middle"](x)
+        self.conv1s = nn.ModuleList([resBlock(self.num_feats, self.num_feats, stride=lower_stride) for _ in range(depth)])
+        self.conv2s = nn.ModuleList([resBlock(self.num_feats, self.num_feats) for _ in range(depth)])
+        if attention_block == None:
+            self.attentions = nn.ModuleList([nn.Identity() for _ in range(depth)])
+        elif attention_block == SELayer:
+            self.attentions = nn.ModuleList([attention_block(self.num_feats) for _ in range(depth)])
+        elif attention_block == CA_Block:
+            self.attentions = nn.ModuleList([attention_block(self.num_feats, self.num_feats) for _ in range(depth)])
         else:
-            # Recursion forward
-            x = self._forward(x, level + 1)
+            raise ValueError("This attention block doesn't exist!")
+        self.middle = resBlock(self.num_feats, self.num_feats)
 
-        x = self._modules[f"conv{level}_2"](x)
-        if self.attention_block != None:
-            x = self._modules[f"attention{level}"](x)
-        x = F.interpolate(x, scale_factor=2, mode='nearest')
+    def _forward(self, x:torch.Tensor) -> torch.Tensor:
+        # Going down: keep the upper branch of every level
+        residuals: List[torch.Tensor] = []
+        for shortcut, conv1 in zip(self.shortcuts, self.conv1s):
+            residuals.append(shortcut(x))
+            if self.downsample is not None:
+                x = self.downsample(x)
+            x = conv1(x)
 
-        return x + residual
+        x = self.middle(x)
 
-    def forward(self, x):
-        if self.add_CoordConv:
+        # Going up: upsample and merge with the upper branch
+        for conv2, attention in zip(self.conv2s, self.attentions):
+            x = conv2(x)
+            x = attention(x)
+            x = upsample_add(x, residuals.pop())
+
+        return x
+
+    def forward(self, x:torch.Tensor) -> torch.Tensor:
+        if self.coordConv is not None:
             x = self.coordConv(x)
 
-        return self._forward(x, 1)
+        return self._forward(x)
 
 class FAN(nn.Module):
     """Facial Alignment network
     """
     def __init__(self, num_HG:int = 4, HG_depth:int = 4, num_feats:int = 256, num_classes:int = 68, resBlock=HPM_ConvBlock, 
-                attention_block=None, use_CoordConv=False, with_r=False, add_CoordConv_inHG=False):
+                attention_block=None, use_CoordConv=False, with_r=False, add_CoordConv_inHG=False, strided_downsample=False):
         super(FAN, self).__init__()
         self.num_HG = num_HG # num of how many hourglass stack
         self.HG_dpeth = HG_depth # num of recursion in hourglass net
         self.num_feats = num_feats
         self.num_classes = num_classes # num of keypoints
+        # channel widths of the base part
+        c4 = self.num_feats // 4
+        c2 = self.num_feats // 2
 
         # Base part
         self.relu = nn.ReLU(inplace=True)
-        self.max_pool2d = nn.MaxPool2d(kernel_size=2, stride=2)
+        # Downsample with pooling or with the stride of conv2
+        if strided_downsample:
+            self.max_pool2d = None
+        else:
+            self.max_pool2d = nn.MaxPool2d(kernel_size=2, stride=2)
         if use_CoordConv:
-            self.conv1 = CoordConv(3, self.num_feats // 4, with_r=with_r, kernel_size=7, stride=2, padding=3)
+            self.conv1 = CoordConv(3, c4, with_r=with_r, kernel_size=7, stride=2, padding=3)
         else:
-            self.conv1 = nn.Conv2d(3, self.num_feats // 4, kernel_size=7, stride=2, padding=3)
-        self.bn1 = nn.BatchNorm2d(self.num_feats // 4)
-        self.conv2 = resBlock(self.num_feats // 4, self.num_feats // 2)
-        self.conv3 = resBlock(self.num_feats // 2, self.num_feats // 2)
-        self.conv4 = resBlock(self.num_feats // 2, self.num_feats)
+            self.conv1 = nn.Conv2d(3, c4, kernel_size=7, stride=2, padding=3)
+        self.bn1 = nn.BatchNorm2d(c4)
+        self.conv2 = resBlock(c4, c2, stride=2 if strided_downsample else 1)
+        self.conv3 = resBlock(c2, c2)
+        self.conv4 = resBlock(c2, self.num_feats)
 
         # Stacked hourglassNet part
-        for stack_idx in range(1, self.num_HG + 1):
-            self.add_module(f"HG{stack_idx}", HourGlassNet(self.HG_dpeth, self.num_feats, resBlock=resBlock, attention_block=attention_block, add_CoordConv=add_CoordConv_inHG, with_r=with_r))
-            self.add_module(f"stack{stack_idx}_conv1", resBlock(self.num_feats, self.num_feats))
-            self.add_module(f"stack{stack_idx}_conv2", conv1x1(self.num_feats, self.num_feats, bias=True))
-            self.add_module(f"stack{stack_idx}_bn1", nn.BatchNorm2d(int(self.num_feats)))
-
-            self.add_module(f"stack{stack_idx}_conv_out", conv1x1(self.num_feats, self.num_classes, bias=True))
-            if stack_idx != self.num_HG:
-                self.add_module(f"stack{stack_idx}_conv3", conv1x1(self.num_feats, self.num_feats, bias=True))
-                self.add_module(f"stack{stack_idx}_shortcut", conv1x1(self.num_classes, self.num_feats, bias=True))
+        self.hgs = nn.ModuleList([HourGlassNet(self.HG_dpeth, self.num_feats, resBlock=resBlock, attention_block=attention_block, 
+                                            add_CoordConv=add_CoordConv_inHG, with_r=with_r, strided_downsample=strided_downsample) 
+                                for _ in range(self.num_HG)])
+        self.stack_conv1 = nn.ModuleList([resBlock(self.num_feats, self.num_feats) for _ in range(self.num_HG)])
+        self.stack_conv2 = nn.ModuleList([conv1x1(self.num_feats, self.num_feats, bias=True) for _ in range(self.num_HG)])
+        self.stack_bn1 = nn.ModuleList([nn.BatchNorm2d(self.num_feats) for _ in range(self.num_HG)])
+        self.stack_conv_out = nn.ModuleList([conv1x1(self.num_feats, self.num_classes, bias=True) for _ in range(self.num_HG)])
+        # The last stack has no lower and upper branch
+        self.stack_conv3 = nn.ModuleList([conv1x1(self.num_feats, self.num_feats, bias=True) for _ in range(self.num_HG - 1)])
+        self.stack_shortcut = nn.ModuleList([conv1x1(self.num_classes, self.num_feats, bias=True) for _ in range(self.num_HG - 1)])
         self._weight_init()
     def _weight_init(self):
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-                m.weight.data.normal_(0, math.sqrt(2. / n))
+                nn.init.normal_(m.weight, 0, math.sqrt(2. / n))
                 if m.bias is not None:
-                    m.bias.data.zero_()
+                    nn.init.zeros_(m.bias)
             elif isinstance(m, nn.BatchNorm2d):
-                m.weight.data.fill_(1)
-                m.bias.data.zero_()
+                nn.init.ones_(m.weight)
+                nn.init.zeros_(m.bias)
             elif isinstance(m, nn.Linear):
-                m.weight.data.normal_(0, 0.01)
-                m.bias.data.zero_()
+                nn.init.normal_(m.weight, 0, 0.01)
+                nn.init.zeros_(m.bias)
 
-    def forward(self, x):
-        outputs = []
+    def fuse(self):
+        """Fold the BN layers which follow a conv into the conv weights, only for inference
+        """
+        if self.training:
+            raise ValueError("Only the model in eval mode can be fused!")
         # Base part
+        if isinstance(self.conv1, CoordConv):
+            self.conv1.conv = fuse_conv_bn_eval(self.conv1.conv, self.bn1)
+        else:
+            self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+        # Stacked hourglassNet part
+        for stack_idx in range(self.num_HG):
+            self.stack_conv2[stack_idx] = fuse_conv_bn_eval(self.stack_conv2[stack_idx], self.stack_bn1[stack_idx])
+            self.stack_bn1[stack_idx] = nn.Identity()
+        return self
+
+    def forward(self, x:torch.Tensor) -> List[torch.Tensor]:
+        outputs: List[torch.Tensor] = []
+        # Base part
+        channels_last = x.is_contiguous(memory_format=torch.channels_last)
         x = self.relu(self.bn1(self.conv1(x)))
+        if channels_last:
+            # Fix the strides after the 7x7 stride-2 stem conv (and CoordConv's concat)
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.conv2(x)
-        x = self.max_pool2d(x)
+        if self.max_pool2d is not None:
+            x = self.max_pool2d(x)
         x = self.conv3(x)
         x = self.conv4(x)
 
-        # Stacked hourglassNet part
-        for stack_idx in range(1, self.num_HG + 1):
-            if stack_idx != self.num_HG:
-                residual = x
-            x = self._modules[f"HG{stack_idx}"](x)
-            x = self._modules[f"stack{stack_idx}_conv1"](x)
-            x = self._modules[f"stack{stack_idx}_conv2"](x)
-            x = self.relu(self._modules[f"stack{stack_idx}_bn1"](x))
+        # Stacked hourglassNet part, zip stops at the shortest list so the last stack is handled apart
+        for hg, conv1, conv2, bn1, conv_out, conv3, shortcut in zip(self.hgs, self.stack_conv1, self.stack_conv2, self.stack_bn1, 
+                                                                    self.stack_conv_out, self.stack_conv3, self.stack_shortcut):
+            residual = x
+            x = hg(x)
+            x = conv1(x)
+            x = conv2(x)
+            x = self.relu(bn1(x))
             # Output heatmap
-            out = self._modules[f"stack{stack_idx}_conv_out"](x)
+            out = conv_out(x)
             outputs.append(out)
             # lower and upper branch
-            if stack_idx != self.num_HG:
-                x = self._modules[f"stack{stack_idx}_conv3"](x)
-                out_ = self._modules[f"stack{stack_idx}_shortcut"](out)
-                x = out_ + residual + x
+            x = conv3(x)
+            out_ = shortcut(out)
+            x = out_ + residual + x
+
+        # Last stack
+        x = self.hgs[-1](x)
+        x = self.stack_conv1[-1](x)
+        x = self.stack_conv2[-1](x)
+        x = self.relu(self.stack_bn1[-1](x))
+        outputs.append(self.stack_conv_out[-1](x))
         return outputs
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from typing import Optional, Tuple
 
 def conv3x3(inplanes:int, planes:int, stride=1, padding=1, bias=False, dilation=1):
     "3x3 convolution"
@@ -9,28 +10,34 @@ def conv3x3(inplanes:int, planes:int, stride=1, padding=1, bias=False, dilation=
                      stride=stride, padding=padding, bias=bias)
 
 
-def conv1x1(inplanes:int, planes:int, bias=False):
+def conv1x1(inplanes:int, planes:int, stride=1, bias=False):
     "1x1 convolution"
     inplanes = int(inplanes)
     planes = int(planes)
     return nn.Conv2d(inplanes, planes, kernel_size=1,bias=bias,
-                     stride=1, padding=0)
+                     stride=stride, padding=0)
+
+def upsample_add(x:torch.Tensor, residual:torch.Tensor) -> torch.Tensor:
+    "2x nearest upsampling of x added to residual, the upsampled x is only broadcast and never written to memory"
+    b, c, h, w = x.size()
+    out = residual.view(b, c, h, 2, w, 2) + x.unsqueeze(3).unsqueeze(5)
+    return out.reshape(b, c, h * 2, w * 2)
 
 class SELayer(nn.Module):
     def __init__(self, channel, reduction=4):
         super(SELayer, self).__init__()
         self.avg_pool = nn.AdaptiveAvgPool2d(1)
+        # 1x1 convs on the pooled (B, C, 1, 1) map, so no reshape is needed
         self.fc = nn.Sequential(
-                nn.Linear(channel, channel // reduction),
+                conv1x1(channel, channel // reduction, bias=True),
                 nn.ReLU(inplace=True),
-                nn.Linear(channel // reduction, channel),
+                conv1x1(channel // reduction, channel, bias=True),
                 nn.Sigmoid(),
         )
 
-    def forward(self, x):
-        b, c, _, _ = x.size()
-        y = self.avg_pool(x).view(b, c)
-        y = self.fc(y).view(b, c, 1, 1)
+    def forward(self, x:torch.Tensor) -> torch.Tensor:
+        y = self.avg_pool(x)
+        y = self.fc(y)
         return x * y
 
 class CA_Block(nn.Module):
@@ -49,7 +56,7 @@ class CA_Block(nn.Module):
         self.conv_w = nn.Conv2d(mip, oup, kernel_size=1, stride=1, padding=0)
         
 
-    def forward(self, x):
+    def forward(self, x:torch.Tensor) -> torch.Tensor:
         identity = x
         
         b,c,h,w = x.size()
@@ -74,10 +81,10 @@ class CA_Block(nn.Module):
 class HPM_ConvBlock(nn.Module):
     """Hierarchical, parallel and multi-scale block
     """
-    def __init__(self, inplanes:int, planes:int):
+    def __init__(self, inplanes:int, planes:int, stride:int=1):
         super(HPM_ConvBlock, self).__init__()
         self.bn1 = nn.BatchNorm2d(inplanes)
-        self.conv1 = conv3x3(inplanes, planes // 2)
+        self.conv1 = conv3x3(inplanes, planes // 2, stride=stride)
         self.bn2 = nn.BatchNorm2d(planes // 2)
         self.conv2 = conv3x3(planes // 2, planes // 4)
         self.bn3 = nn.BatchNorm2d(planes // 4)
@@ -85,16 +92,16 @@ class HPM_ConvBlock(nn.Module):
 
         # self.attention = CA_Block(planes, planes)
         self.relu = nn.ReLU(inplace=True)
-        if inplanes != planes:
+        if inplanes != planes or stride != 1:
             self.shortcut = nn.Sequential(
                 nn.BatchNorm2d(inplanes),
                 nn.ReLU(inplace=True),
-                conv1x1(inplanes, planes)
+                conv1x1(inplanes, planes, stride=stride)
             )
         else:
             self.shortcut = None
 
-    def forward(self, x):
+    def forward(self, x:torch.Tensor) -> torch.Tensor:
         residual = x
 
         out1 = self.bn1(x)
@@ -109,14 +116,16 @@ class HPM_ConvBlock(nn.Module):
         out3 = self.relu(out3)
         out3 = self.conv3(out3)
 
-        out3 = torch.cat([out1, out2, out3], axis=1)
+        out3 = torch.cat([out1, out2, out3], dim=1)
         # out3 = self.attention(out3)
-        if self.shortcut != None:
+        if self.shortcut is not None:
             residual =  self.shortcut(residual)
         out3 += residual
 
         return out3
 class AddCoords(nn.Module):
+    xx_channel: Optional[torch.Tensor]
+    yy_channel: Optional[torch.Tensor]
 
     def __init__(self, with_r=False):
         super().__init__()
@@ -124,41 +133,37 @@ class AddCoords(nn.Module):
 
         self.xx_channel = None
         self.yy_channel = None
-        self.r_channel = None
         self.speed_up = True
 
-    def get_xxyy(self, input_tensor):
-        batch_size, _, x_dim, y_dim = input_tensor.size()
-        def gen_xx_yy():
-            xx_channel = torch.arange(x_dim).repeat(1, y_dim, 1)
-            yy_channel = torch.arange(y_dim).repeat(1, x_dim, 1).transpose(1, 2)
+    def gen_xx_yy(self, batch_size:int, x_dim:int, y_dim:int, device:torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        xx_channel = torch.arange(x_dim, device=device).repeat(1, y_dim, 1)
+        yy_channel = torch.arange(y_dim, device=device).repeat(1, x_dim, 1).transpose(1, 2)
 
-            xx_channel = xx_channel / (x_dim - 1)
-            yy_channel = yy_channel / (y_dim - 1)
+        xx_channel = xx_channel / (x_dim - 1)
+        yy_channel = yy_channel / (y_dim - 1)
 
-            xx_channel = xx_channel * 2 - 1
-            yy_channel = yy_channel * 2 - 1
+        xx_channel = xx_channel * 2 - 1
+        yy_channel = yy_channel * 2 - 1
 
-            xx_channel = xx_channel.repeat(batch_size, 1, 1, 1).transpose(2, 3)
-            yy_channel = yy_channel.repeat(batch_size, 1, 1, 1).transpose(2, 3)
-            
-            return xx_channel, yy_channel
+        xx_channel = xx_channel.repeat(batch_size, 1, 1, 1).transpose(2, 3)
+        yy_channel = yy_channel.repeat(batch_size, 1, 1, 1).transpose(2, 3)
+        
+        return xx_channel, yy_channel
 
+    def get_xxyy(self, input_tensor:torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch_size, _, x_dim, y_dim = input_tensor.size()
         if self.speed_up:
-            if self.xx_channel == None:
-                self.xx_channel, self.yy_channel = gen_xx_yy()
-                if input_tensor.is_cuda:
-                    self.xx_channel = self.xx_channel.cuda()
-                    self.yy_channel = self.yy_channel.cuda()
-            return self.xx_channel[:batch_size].clone(), self.yy_channel[:batch_size].clone()
+            xx_channel = self.xx_channel
+            yy_channel = self.yy_channel
+            if xx_channel is None or yy_channel is None:
+                xx_channel, yy_channel = self.gen_xx_yy(batch_size, x_dim, y_dim, input_tensor.device)
+                self.xx_channel = xx_channel
+                self.yy_channel = yy_channel
+            return xx_channel[:batch_size].clone(), yy_channel[:batch_size].clone()
         else:
-            xx_channel, yy_channel = gen_xx_yy()
-            if input_tensor.is_cuda:
-                xx_channel = xx_channel.cuda()
-                yy_channel = yy_channel.cuda() 
-            return xx_channel, yy_channel
+            return self.gen_xx_yy(batch_size, x_dim, y_dim, input_tensor.device)
             
-    def forward(self, input_tensor):
+    def forward(self, input_tensor:torch.Tensor) -> torch.Tensor:
         """
         Args:
             input_tensor: shape(batch, channel, x_dim, y_dim)
@@ -171,11 +176,8 @@ class AddCoords(nn.Module):
                     yy_channel.type_as(input_tensor)], dim=1)
 
         if self.with_r:
-            rr = self.get_r(input_tensor.size())
             rr = torch.sqrt(torch.pow(xx_channel - 0.5, 2) + torch.pow(yy_channel - 0.5, 2))
-            if input_tensor.is_cuda:
-                rr = rr.cuda()
-            ret = torch.cat([ret, rr], dim=1)
+            ret = torch.cat([ret, rr.type_as(input_tensor)], dim=1)
 
         return ret
 
@@ -187,7 +189,7 @@ class CoordConv(nn.Module):
         extra_channel = 3 if with_r else 2
         self.conv = nn.Conv2d(in_channels + extra_channel, out_channels, **kwargs)
 
-    def forward(self, x):
+    def forward(self, x:torch.Tensor) -> torch.Tensor:
         ret = self.addcoords(x)
         ret = self.conv(ret)
         return ret
\ No newline at end of file
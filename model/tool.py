@@ -1,3 +1,4 @@
+import torch
 from model.FAN import FAN
 from model.blocks import CA_Block, SELayer
 
@@ -18,6 +19,23 @@ def get_model(cfg:dict):
     use_CoordConv = cfg['use_CoordConv']
     add_CoordConv_inHG = cfg['add_CoordConv_inHG']
     with_r = cfg['with_r']
+    strided_downsample = cfg['strided_downsample']
 
     return FAN(num_HG, HG_depth, num_feats, attention_block=attention_block,
-            use_CoordConv=use_CoordConv, add_CoordConv_inHG=add_CoordConv_inHG, with_r=with_r)
+            use_CoordConv=use_CoordConv, add_CoordConv_inHG=add_CoordConv_inHG, with_r=with_r,
+            strided_downsample=strided_downsample)
+
+
+def script_model(model, example_input:torch.Tensor):
+    """Compile the model with TorchScript for inference only, the BN layers are folded into the previous convs
+    Args:
+        model: the model which has been loaded parameters
+        example_input: a batch of images on the model device, used to warm up the compiled graph
+    """
+    model = torch.jit.script(model.eval())
+    model = torch.jit.optimize_for_inference(model)
+    # The first calls are slow since the graph is specialized and optimized on them
+    with torch.no_grad():
+        for _ in range(2):
+            model(example_input)
+    return model
@@ -4,7 +4,7 @@ from dataset.tool import get_pred_dataset
 from utils.tool import load_parameters
 from utils.visualize import read_img, plot_keypoints
 from utils.evaluation import *
-from model.tool import get_model
+from model.tool import get_model, script_model
 from cfg import *
 from tqdm import tqdm
 import argparse
@@ -36,6 +36,8 @@ def main():
     parser.add_argument('--data_path', default="../aflw_test")
     #parser.add_argument('--type', type=str, default="test")
     parser.add_argument('--show_result', action="store_true")
+    parser.add_argument('--fuse', help="fold the BN layers into the convs", action="store_true")
+    parser.add_argument('--jit', help="compile the model with TorchScript", action="store_true")
     args = parser.parse_args()
     
     ### Parameters ###
@@ -53,6 +55,11 @@ def main():
     model = get_model(cfg)
 
     load_parameters(model, model_path)
+    if args.fuse:
+        model = model.eval().fuse()
+    if args.jit:
+        model = model.to(device)
+        model = script_model(model, next(iter(test_loader)).to(device))
     preds = pred_imgs(model=model, 
                         test_loader=test_loader, 
                         device=device,
@@ -34,6 +34,8 @@ def heatmap_to_landmark(heatmap, max_diff=0.26, fix_coord=True):
             heatmap = heatmap.detach().cpu()
     else:
         heatmap = to_tensor(heatmap)
+    # Heatmaps predicted under autocast are half precision
+    heatmap = heatmap.float()
 
     if len(heatmap.shape) == 4:
         bs, c, h, w = heatmap.shape
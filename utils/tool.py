@@ -7,6 +7,7 @@ from tqdm import tqdm
 import random
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 def mkdir_if_exist(path:str):
     if not os.path.isdir(path):
@@ -36,22 +37,97 @@ def load_parameters(model, path, optimizer=None, epoch:int=0):
 
     print("End of loading !!!")
 
-def val(model, test_loader, device, fix_coord=False):
+class Data_prefetcher(object):
+    """Copy the next batch to the device on a side stream while the current batch is being processed
+    Args:
+        loader: the dataloader which yields dict samples
+        device: the target device
+        keys: the keys of the sample which should be moved to the device
+        memory_format: memory format of the 4D tensors
+    """
+    def __init__(self, loader, device, keys=('img', 'label', 'weight_map'), memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.keys = keys
+        self.memory_format = memory_format
+        self.use_stream = (self.device.type == 'cuda')
+        self.stream = torch.cuda.Stream(self.device) if self.use_stream else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, sample:dict):
+        for key in self.keys:
+            if key not in sample:
+                continue
+            if sample[key].dim() == 4:
+                sample[key] = sample[key].to(self.device, memory_format=self.memory_format, non_blocking=True)
+            else:
+                sample[key] = sample[key].to(self.device, non_blocking=True)
+        return sample
+
+    def _preload(self, loader_iter):
+        try:
+            sample = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_device(sample)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        if not self.use_stream:
+            for sample in loader_iter:
+                yield self._to_device(sample)
+            return
+
+        next_sample = self._preload(loader_iter)
+        while next_sample != None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            sample = next_sample
+            # The tensors are allocated on the side stream but consumed on the current one
+            for key in self.keys:
+                if key in sample:
+                    sample[key].record_stream(current_stream)
+            next_sample = self._preload(loader_iter)
+            yield sample
+
+def state_to_cpu(state):
+    """Copy the tensors of a (nested) state dict to the host, so it can be saved while the training goes on
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        cpu_state = type(state)((k, state_to_cpu(v)) for k, v in state.items())
+        if hasattr(state, '_metadata'):
+            cpu_state._metadata = state._metadata
+        return cpu_state
+    elif isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    else:
+        return state
+
+def save_checkpoints(checkpoints:list):
+    for state, path in checkpoints:
+        torch.save(state, path)
+
+def val(model, test_loader, device, fix_coord=False, channels_last=False, use_amp=False):
     print("Starting Validation....")
-    
-    model = model.to(device)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = model.to(device, memory_format=memory_format)
     
     total_NME_loss = 0
     total_NEM_loss_68 = np.zeros(68)
     num_data = 0
 
     model.eval()
-    for sample in tqdm(test_loader):
-        with torch.no_grad():
+    for sample in tqdm(Data_prefetcher(test_loader, device, keys=('img',), memory_format=memory_format)):
+        with torch.inference_mode():
             img, gt_label = sample['img'], sample['gt_label']
-            img = img.to(device)
 
-            outputs = model(img)
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                outputs = model(img)
             pred = heatmap_to_landmark(outputs,fix_coord=fix_coord)
             pred_loss, pred_loss_68 = NME(pred, gt_label, average=False, return_68=True)
             num_data += img.shape[0]
@@ -63,22 +139,30 @@ def val(model, test_loader, device, fix_coord=False):
     return (total_NME_loss / num_data), (total_NEM_loss_68 / num_data)
 
 def process_loss(loss_type:str, criterion, outputs:torch.Tensor, label:torch.Tensor, weight_map:torch.Tensor=None):
-    loss = 0
     num_target = (label > 0).sum()  
+    # Calculate the loss of all stacks with one call, shape = (num_HG, bs, 68, h, w)
+    num_outputs = len(outputs)
+    outputs = torch.stack(outputs, dim=0)
+    label = label.unsqueeze(0).expand_as(outputs)
     if loss_type =="L2":
-        for output in outputs:
-            loss += criterion(output, label) / num_target
+        loss = criterion(outputs, label)
     elif loss_type == "weighted_L2" or loss_type == "adaptive_wing_loss":
         if weight_map == None:
             raise ValueError("Weight map cannot be None!")
-        for output in outputs:
-            loss += criterion(output, label, weight_map) / num_target
+        weight_map = weight_map.unsqueeze(0).expand_as(outputs)
+        loss = criterion(outputs, label, weight_map)
+        if loss_type == "adaptive_wing_loss":
+            # Adaptive wing loss is averaged over all elements, scale it back to the sum over stacks
+            loss = loss * num_outputs
+    else:
+        raise ValueError("This loss type doesn't exist!")
 
-    return loss
+    return loss / num_target
 
 
 def train(model, train_loader, val_loader, test_loader, epoch:int, save_path:str, device, criterion, scheduler, optimizer, 
-        loss_type:str, exp_name="", train_hyp=dict(), resume_epoch=-1, fix_coord=False, every_step_update=1):
+        loss_type:str, exp_name="", train_hyp=dict(), resume_epoch=-1, fix_coord=False, every_step_update=1, channels_last=False,
+        use_amp=False, compile_model=False):
     start_train = time.time()
     # Create writer for recording loss
     if exp_name == "":
@@ -99,6 +183,41 @@ def train(model, train_loader, val_loader, test_loader, epoch:int, save_path:str
 
     use_weight_map = (loss_type == "weighted_L2") or (loss_type == "adaptive_wing_loss")
 
+    # Memory format of the model and its inputs
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = model.to(device, memory_format=memory_format)
+    # Loss scaler for mixed precision training
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
+    # Compile the model, the state dict is still saved from the original model
+    net = model
+    if compile_model:
+        if not hasattr(torch, 'compile'):
+            raise ValueError("torch.compile needs PyTorch >= 2.0!")
+        img = next(iter(train_loader))['img'].to(device, memory_format=memory_format)
+        # An eager forward first, so the cached coordinate maps of CoordConv are plain tensors instead of graph outputs
+        model.eval()
+        with torch.no_grad():
+            model(img)
+        net = torch.compile(model, mode='reduce-overhead', fullgraph=True)
+        # Warm up, the first calls trace the model and record the CUDA graphs
+        model.train()
+        for _ in range(2):
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                outputs = net(img)
+            sum(output.float().sum() for output in outputs).backward()
+        optimizer.zero_grad(set_to_none=True)
+        del img, outputs
+
+    # Checkpoints are saved in a background thread, with at most one save in flight
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+
+    # Size of the datasets
+    num_train_iters = len(train_loader)
+    num_train = len(train_loader.dataset)
+    num_val = len(val_loader.dataset)
+
     # Resume train or not
     if resume_epoch != -1:
         print("Resume training!!")
@@ -121,63 +240,63 @@ def train(model, train_loader, val_loader, test_loader, epoch:int, save_path:str
         model.train()
         train_loss = 0.0
         optimizer.zero_grad(set_to_none=True)
-        for i, sample in enumerate(tqdm(train_loader)):
+        for i, sample in enumerate(tqdm(Data_prefetcher(train_loader, device, memory_format=memory_format))):
             img, label = sample['img'], sample['label']
             # Add weight map
             weight_map = None
             if use_weight_map:
-                weight_map = sample['weight_map'].to(device)
+                weight_map = sample['weight_map']
 
             # Forward part
-            img = img.to(device)
-            label = label.to(device)
-            outputs = model(img)
-            # Calculate Loss
-            loss = process_loss(loss_type, criterion, outputs, label, weight_map)   
-            # Backward and update
-            train_loss += loss.item()
-
-            loss.backward()
-            if i % every_step_update == 0 or i == len(train_loader):
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                outputs = net(img)
+                # Calculate Loss
+                loss = process_loss(loss_type, criterion, outputs, label, weight_map)   
+            # Backward and update, detach to avoid a device sync on every step
+            train_loss += loss.detach()
+
+            scaler.scale(loss).backward()
+            if i % every_step_update == 0 or i == num_train_iters:
+                # Unscale before clipping so that max_norm applies to the real gradients
+                scaler.unscale_(optimizer)
                 nn.utils.clip_grad_norm_(model.parameters(), max_norm=5.)
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad(set_to_none=True)
                 # warm up step
                 scheduler.step()
-            del loss
   
         # Recording Epoch loss with tensorboard
-        train_loss /= len(train_loader.dataset)
+        train_loss = float(train_loss) / num_train
         writer.add_scalar(tag="train/loss",
                         scalar_value=float(train_loss), 
                         global_step=epoch)
 
         
         # validation part 
-        with torch.no_grad():
+        with torch.inference_mode():
             model.eval()
             val_loss = 0.0
             val_NME_loss = 0.0
-            for sample in tqdm(val_loader):
+            for sample in tqdm(Data_prefetcher(val_loader, device, memory_format=memory_format)):
                 img, label, gt_label = sample['img'], sample['label'], sample['gt_label']
 
                 # Weight map
                 weight_map = None
                 if use_weight_map:
-                    weight_map = sample['weight_map'].to(device)
-                img = img.to(device)
-                label = label.to(device)
-                outputs = model(img)
-                loss = process_loss(loss_type, criterion, outputs, label, weight_map)
-                val_loss += loss.item()
+                    weight_map = sample['weight_map']
+                with torch.cuda.amp.autocast(enabled=use_amp):
+                    outputs = net(img)
+                    loss = process_loss(loss_type, criterion, outputs, label, weight_map)
+                val_loss += loss.detach()
                 # Calculate loss with groud truth label
                 pred_label = heatmap_to_landmark(outputs, fix_coord=fix_coord)
 
                 val_NME_loss += NME(pred_label, gt_label)
 
             
-            val_loss /= len(val_loader.dataset)
-            val_NME_loss /= len(val_loader.dataset)
+            val_loss = float(val_loss) / num_val
+            val_NME_loss /= num_val
             writer.add_scalar(tag="val/NME_loss",
                             scalar_value=float(val_NME_loss), 
                             global_step=epoch)
@@ -185,7 +304,8 @@ def train(model, train_loader, val_loader, test_loader, epoch:int, save_path:str
                             scalar_value=float(val_loss), 
                             global_step=epoch)
         # Testing part
-        test_NME_loss, _ = val(model, test_loader, device, fix_coord=fix_coord)
+        test_NME_loss, _ = val(net, test_loader, device, fix_coord=fix_coord, channels_last=channels_last, 
+                                use_amp=use_amp)
         writer.add_scalar(tag="val/test_NME_loss",
                                 scalar_value=float(test_NME_loss), 
                                 global_step=epoch)
@@ -202,18 +322,27 @@ def train(model, train_loader, val_loader, test_loader, epoch:int, save_path:str
         print(formatted_str.format('Testing NME loss', test_NME_loss))
         print('='*24 + '\n')
 
+        model_state = state_to_cpu(model.state_dict())
+        checkpoints = []
         if test_NME_loss < best_test_NME_loss:
             best_test_NME_loss = test_NME_loss
             best_test_epoch = epoch
-            torch.save(model.state_dict(), os.path.join(save_path, 'best.pt'))
+            checkpoints.append((model_state, os.path.join(save_path, 'best.pt')))
         if val_NME_loss < best_val_NME_loss:
             best_val_NME_loss = val_NME_loss
             best_val_epoch = epoch
         
         # Save model, scheduler and optimizer
-        torch.save(model.state_dict(), os.path.join(save_path, f'{epoch}.pt'))
-        torch.save(optimizer.state_dict(), os.path.join(save_path, f'optimizer_{epoch}.pt'))
-
+        checkpoints.append((model_state, os.path.join(save_path, f'{epoch}.pt')))
+        checkpoints.append((state_to_cpu(optimizer.state_dict()), os.path.join(save_path, f'optimizer_{epoch}.pt')))
+        if pending_save != None:
+            pending_save.result()
+        pending_save = save_executor.submit(save_checkpoints, checkpoints)
+
+    # Wait for the last checkpoints
+    if pending_save != None:
+        pending_save.result()
+    save_executor.shutdown(wait=True)
     
     print("End of training !!!")
     print(f"Best validating NME loss {best_val_NME_loss:.6f} on epoch {best_val_epoch}")